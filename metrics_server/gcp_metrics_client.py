@@ -1,14 +1,21 @@
 import asyncio
+import contextlib
 import dataclasses
 import datetime
-import statistics
+import os
+import re
+import sys
 import time
 import typing
+import warnings
 
 import google.cloud.monitoring_v3
+import numpy
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(
+    slots=True,
+)
 class ContainerMetrics:
     container_name: str
     top_level_controller_name: str
@@ -25,283 +32,490 @@ class ContainerMetrics:
     unutilized_cpu: float = 0
 
 
-class MetricsClient:
-    def __init__(
-        self,
-        project,
-        namespaces,
-        duration_days,
-    ):
-        self.metrics_client = google.cloud.monitoring_v3.services.metric_service.MetricServiceAsyncClient()
-        self.project = project
-        self.namespaces = namespaces
-
-        seconds = int(time.time())
-        self.duration = int(
-            datetime.timedelta(
-                days=duration_days,
-            ).total_seconds(),
-        )
-        self.interval = google.cloud.monitoring_v3.TimeInterval(
-            {
-                'end_time': {
-                    'seconds': seconds,
-                    'nanos': 0,
-                },
-                'start_time': {
-                    'seconds': (seconds - self.duration),
-                    'nanos': 0,
-                },
-            },
+def reduce_series_points(
+    series_points,
+):
+    point_counts = numpy.fromiter(
+        (len(points) for points in series_points),
+        dtype=numpy.int64,
+        count=len(series_points),
+    )
+    offsets = numpy.zeros_like(point_counts)
+    numpy.cumsum(point_counts[:-1], out=offsets[1:])
+
+    values = numpy.fromiter(
+        (point.values[0].double_value for points in series_points for point in points),
+        dtype=numpy.float64,
+        count=int(point_counts.sum()),
+    )
+
+    return {
+        'mean': (numpy.add.reduceat(values, offsets) / point_counts).tolist(),
+        'max': numpy.maximum.reduceat(values, offsets).tolist(),
+        'latest': values[offsets].tolist(),
+    }
+
+
+def update_unutilized_memory(
+    container,
+):
+    container.unutilized_memory = max(
+        0,
+        container.memory_request - container.max_memory_usage,
+    )
+
+
+def update_unutilized_cpu(
+    container,
+):
+    container.unutilized_cpu = max(
+        0,
+        container.cpu_request - container.max_cpu_usage,
+    )
+
+
+@dataclasses.dataclass(frozen=True)
+class MetricColumn:
+    field: str
+    metric_type: str
+    aligner: str
+    reducer: str
+    value_type: type
+    reduce_points: str
+
+
+MEMORY_COLUMNS = (
+    MetricColumn(
+        field='avg_memory_request_utilization',
+        metric_type='kubernetes.io/container/memory/request_utilization',
+        aligner='mean_aligner',
+        reducer='mean',
+        value_type=float,
+        reduce_points='mean',
+    ),
+    MetricColumn(
+        field='max_memory_usage',
+        metric_type='kubernetes.io/container/memory/used_bytes',
+        aligner='max_aligner',
+        reducer='max',
+        value_type=int,
+        reduce_points='max',
+    ),
+    MetricColumn(
+        field='avg_memory_usage',
+        metric_type='kubernetes.io/container/memory/used_bytes',
+        aligner='mean_aligner',
+        reducer='mean',
+        value_type=float,
+        reduce_points='mean',
+    ),
+    MetricColumn(
+        field='memory_request',
+        metric_type='kubernetes.io/container/memory/request_bytes',
+        aligner='max_aligner',
+        reducer='max',
+        value_type=int,
+        reduce_points='latest',
+    ),
+)
+
+CPU_COLUMNS = (
+    MetricColumn(
+        field='avg_cpu_request_utilization',
+        metric_type='kubernetes.io/container/cpu/request_utilization',
+        aligner='mean_aligner',
+        reducer='mean',
+        value_type=float,
+        reduce_points='mean',
+    ),
+    MetricColumn(
+        field='max_cpu_usage',
+        metric_type='kubernetes.io/container/cpu/core_usage_time',
+        aligner='rate',
+        reducer='max',
+        value_type=float,
+        reduce_points='max',
+    ),
+    MetricColumn(
+        field='avg_cpu_usage',
+        metric_type='kubernetes.io/container/cpu/core_usage_time',
+        aligner='rate',
+        reducer='mean',
+        value_type=float,
+        reduce_points='latest',
+    ),
+    MetricColumn(
+        field='cpu_request',
+        metric_type='kubernetes.io/container/cpu/request_cores',
+        aligner='mean_aligner',
+        reducer='max',
+        value_type=float,
+        reduce_points='latest',
+    ),
+)
+
+GROUP_BY_LABELS = (
+    'resource.namespace_name',
+    'resource.container_name',
+    'metadata.system.top_level_controller_name',
+)
+
+COLUMN_LABEL = 'column'
+
+NAMESPACE_PATTERN = re.compile(r'[a-z0-9]([-a-z0-9]{0,61}[a-z0-9])?')
+
+ALIGNMENT_PERIOD = '3h'
+ALIGNMENT_PERIOD_SECONDS = 60 * 60 * 3
+
+# MQL is deprecated upstream and query_time_series warns on every call.
+warnings.filterwarnings(
+    'ignore',
+    message='QueryServiceAsyncClient.query_time_series is deprecated',
+    category=DeprecationWarning,
+)
+
+_aggregation_cache: typing.Dict[MetricColumn, str] = {}
+
+_query_client: typing.Optional[google.cloud.monitoring_v3.QueryServiceAsyncClient] = None
+_query_client_lock = asyncio.Lock()
+
+_max_slots = int(os.getenv('METRICS_MAX_CONCURRENCY', '10'))
+_slots_in_use = 0
+_slots_condition = asyncio.Condition()
+
+_max_requests_per_second = float(os.getenv('METRICS_MAX_QPS', '0'))
+_next_request_time = 0.0
+_rate_lock = asyncio.Lock()
+
+
+def validate_namespaces(
+    namespaces,
+):
+    for namespace in namespaces or ():
+        if not NAMESPACE_PATTERN.fullmatch(namespace):
+            raise ValueError(f'invalid namespace: {namespace!r}')
+
+
+async def get_query_client():
+    global _query_client
+
+    async with _query_client_lock:
+        if _query_client is None:
+            _query_client = google.cloud.monitoring_v3.QueryServiceAsyncClient()
+
+    return _query_client
+
+
+def get_aggregation(
+    column,
+):
+    aggregation = _aggregation_cache.get(column)
+    if aggregation is None:
+        _aggregation_cache[column] = aggregation = (
+            f'align {column.aligner}({ALIGNMENT_PERIOD})'
+            f' | group_by [{", ".join(GROUP_BY_LABELS)}], [value: cast_double({column.reducer}(val()))]'
+            f" | map add [{COLUMN_LABEL}: '{column.field}']"
         )
 
-        self.request_semaphore = asyncio.Semaphore(
-            value=10,
-        )
+    return aggregation
 
-        self.container_metrics = {}
 
-    async def query(
-        self,
-        aligner,
-        reducer,
-        query_filter,
-    ):
-        query_filter += ' AND resource.labels.namespace_name != "kube-system"'
+async def set_max_slots(
+    max_slots,
+):
+    global _max_slots
 
-        if self.namespaces:
-            query_filter += ' AND (' + ' OR '.join(
-                f'resource.labels.namespace_name = "{namespace}"' for namespace in self.namespaces
-            ) + ')'
+    async with _slots_condition:
+        _max_slots = max_slots
+        _slots_condition.notify_all()
 
-        aggregation = google.cloud.monitoring_v3.Aggregation(
-            {
-                'alignment_period': {
-                    'seconds': 60 * 60 * 3,
-                },
-                'per_series_aligner': aligner,
-                'cross_series_reducer': reducer,
-                'group_by_fields': [
-                    'resource.labels.namespace_name',
-                    'resource.container_name',
-                    'metadata.system_labels.top_level_controller_name',
-                ],
-            },
-        )
 
-        async with self.request_semaphore:
-            return await self.metrics_client.list_time_series(
-                request={
-                    'name': f'projects/{self.project}',
-                    'filter': query_filter,
-                    'interval': self.interval,
-                    'view': google.cloud.monitoring_v3.ListTimeSeriesRequest.TimeSeriesView.FULL,
-                    'aggregation': aggregation,
-                }
-            )
+def set_max_requests_per_second(
+    max_requests_per_second,
+):
+    global _max_requests_per_second
 
-    def upsert_container(
-        self,
-        metrics,
-    ):
-        container_key = (
-            metrics.resource.labels['namespace_name'],
-            metrics.resource.labels['container_name'],
-            metrics.metadata.system_labels['top_level_controller_name'],
-        )
+    _max_requests_per_second = max_requests_per_second
 
-        container = self.container_metrics.get(container_key)
-        if not container:
-            self.container_metrics[container_key] = container = ContainerMetrics(
-                namespace=metrics.resource.labels['namespace_name'],
-                container_name=metrics.resource.labels['container_name'],
-                top_level_controller_name=metrics.metadata.system_labels['top_level_controller_name'],
-            )
 
-        return container
+async def wait_for_rate_limit():
+    global _next_request_time
 
-    async def query_memory_utilization(
-        self,
-    ) -> typing.List[ContainerMetrics]:
-        await asyncio.gather(
-            self.query_avg_memory_request_utilization(),
-            self.query_max_memory_usage(),
-            self.query_avg_memory_usage(),
-            self.query_memory_request(),
-        )
+    if _max_requests_per_second <= 0:
+        return
 
-        for container_key, metrics in list(self.container_metrics.items()):
-            if 'overprovisioner' in metrics.container_name:
-                del self.container_metrics[container_key]
+    async with _rate_lock:
+        now = time.monotonic()
+        delay = _next_request_time - now
+        _next_request_time = max(now, _next_request_time) + 1 / _max_requests_per_second
 
-                continue
+    if delay > 0:
+        await asyncio.sleep(delay)
 
-            metrics.unutilized_memory = max(
-                0,
-                metrics.memory_request - metrics.max_memory_usage,
-            )
 
-        return list(self.container_metrics.values())
+@contextlib.asynccontextmanager
+async def request_slot():
+    global _slots_in_use
 
-    async def query_avg_memory_request_utilization(
-        self,
-    ):
-        results = await self.query(
-            aligner=google.cloud.monitoring_v3.Aggregation.Aligner.ALIGN_MEAN,
-            reducer=google.cloud.monitoring_v3.Aggregation.Reducer.REDUCE_MEAN,
-            query_filter='metric.type = "kubernetes.io/container/memory/request_utilization"',
-        )
+    async with _slots_condition:
+        await _slots_condition.wait_for(lambda: _slots_in_use < _max_slots)
+        _slots_in_use += 1
 
-        async for metrics in results:
-            container = self.upsert_container(
-                metrics=metrics,
-            )
+    try:
+        await wait_for_rate_limit()
 
-            container.avg_memory_request_utilization = statistics.mean([
-                point.value.double_value for point in metrics.points
-            ])
+        yield
+    finally:
+        async with _slots_condition:
+            _slots_in_use -= 1
+            _slots_condition.notify(1)
 
-    async def query_max_memory_usage(
-        self,
-    ):
-        results = await self.query(
-            aligner=google.cloud.monitoring_v3.Aggregation.Aligner.ALIGN_MAX,
-            reducer=google.cloud.monitoring_v3.Aggregation.Reducer.REDUCE_MAX,
-            query_filter='metric.type = "kubernetes.io/container/memory/used_bytes"',
-        )
 
-        async for metrics in results:
-            container = self.upsert_container(
-                metrics=metrics,
-            )
+async def rate_limited_pages(
+    pager,
+):
+    async with contextlib.aclosing(pager.pages) as pages:
+        async for page in pages:
+            yield page
 
-            container.max_memory_usage = max(
-                metrics.points,
-                key=lambda point: point.value.int64_value
-            ).value.int64_value
+            if pager.next_page_token:
+                await wait_for_rate_limit()
 
-    async def query_avg_memory_usage(
-        self,
-    ):
-        results = await self.query(
-            aligner=google.cloud.monitoring_v3.Aggregation.Aligner.ALIGN_MEAN,
-            reducer=google.cloud.monitoring_v3.Aggregation.Reducer.REDUCE_MEAN,
-            query_filter='metric.type = "kubernetes.io/container/memory/used_bytes"',
-        )
 
-        async for metrics in results:
-            container = self.upsert_container(
-                metrics=metrics,
-            )
+async def prefetch(
+    async_iterable,
+    buffer_size=4,
+):
+    queue = asyncio.Queue(
+        maxsize=buffer_size,
+    )
+    end_of_iteration = object()
 
-            container.avg_memory_usage = statistics.mean([
-                point.value.double_value for point in metrics.points
-            ])
+    async def produce():
+        try:
+            async for item in async_iterable:
+                await queue.put((item, None))
+        except Exception as exception:
+            await queue.put((end_of_iteration, exception))
+        else:
+            await queue.put((end_of_iteration, None))
 
-    async def query_memory_request(
-        self,
-    ):
-        results = await self.query(
-            aligner=google.cloud.monitoring_v3.Aggregation.Aligner.ALIGN_MAX,
-            reducer=google.cloud.monitoring_v3.Aggregation.Reducer.REDUCE_MAX,
-            query_filter='metric.type = "kubernetes.io/container/memory/request_bytes"',
-        )
+    producer = asyncio.ensure_future(produce())
 
-        async for metrics in results:
-            container = self.upsert_container(
-                metrics=metrics,
-            )
+    try:
+        while True:
+            item, exception = await queue.get()
+            if exception is not None:
+                raise exception
+            if item is end_of_iteration:
+                break
 
-            container.memory_request = metrics.points[0].value.int64_value
+            yield item
+    finally:
+        producer.cancel()
 
-    async def query_cpu_utilization(
+        await asyncio.wait([producer])
+
+
+class MetricsClient:
+    def __init__(
         self,
-    ) -> typing.List[ContainerMetrics]:
-        await asyncio.gather(
-            self.query_avg_cpu_request_utilization(),
-            self.query_max_cpu_usage(),
-            self.query_avg_cpu_usage(),
-            self.query_cpu_request(),
+        project,
+        namespaces,
+        duration_days,
+    ):
+        validate_namespaces(
+            namespaces=namespaces,
         )
 
-        for container_key, metrics in list(self.container_metrics.items()):
-            if 'overprovisioner' in metrics.container_name:
-                del self.container_metrics[container_key]
+        self.query_client = None
+        self.project = project
+        self.project_name = f'projects/{project}'
+        self.namespaces = namespaces
+        self.duration_days = duration_days
 
-                continue
+        self.query_filter = (
+            "filter resource.namespace_name != 'kube-system'"
+            " && resource.container_name !~ '.*overprovisioner.*'"
+        )
+        if namespaces:
+            self.query_filter += ' && (' + ' || '.join(
+                f"resource.namespace_name == '{namespace}'" for namespace in namespaces
+            ) + ')'
 
-            metrics.unutilized_cpu = max(
-                0,
-                metrics.cpu_request - metrics.max_cpu_usage,
-            )
+    def build_mql(
+        self,
+        columns,
+    ):
+        tables = ' ; '.join(
+            f"metric '{column.metric_type}' | {self.query_filter} | {get_aggregation(column)}"
+            for column in columns
+        )
 
-        return list(self.container_metrics.values())
+        return (
+            f'fetch k8s_container | {{ {tables} }}'
+            f' | union'
+            f' | every {ALIGNMENT_PERIOD}'
+            f" | within {self.duration_days}d, d'{self.end_time():%Y/%m/%d %H:%M}'"
+        )
 
-    async def query_avg_cpu_request_utilization(
+    def end_time(
         self,
     ):
-        results = await self.query(
-            aligner=google.cloud.monitoring_v3.Aggregation.Aligner.ALIGN_MEAN,
-            reducer=google.cloud.monitoring_v3.Aggregation.Reducer.REDUCE_MEAN,
-            query_filter='metric.type = "kubernetes.io/container/cpu/request_utilization"',
+        seconds = int(time.time())
+        seconds -= seconds % ALIGNMENT_PERIOD_SECONDS
+
+        return datetime.datetime.fromtimestamp(
+            seconds,
+            tz=datetime.timezone.utc,
         )
 
-        async for metrics in results:
-            container = self.upsert_container(
-                metrics=metrics,
+    async def query_mql(
+        self,
+        mql,
+    ):
+        if self.query_client is None:
+            self.query_client = await get_query_client()
+
+        async with request_slot():
+            results = await self.query_client.query_time_series(
+                request=google.cloud.monitoring_v3.QueryTimeSeriesRequest(
+                    name=self.project_name,
+                    query=mql,
+                ),
             )
 
-            container.avg_cpu_request_utilization = statistics.mean([
-                point.value.double_value for point in metrics.points
-            ])
+            async with contextlib.aclosing(prefetch(rate_limited_pages(results))) as pages:
+                async for page in pages:
+                    yield page
 
-    async def query_max_cpu_usage(
+    def upsert_container(
         self,
+        container_metrics,
+        namespace,
+        container_name,
+        top_level_controller_name,
     ):
-        results = await self.query(
-            aligner=google.cloud.monitoring_v3.Aggregation.Aligner.ALIGN_RATE,
-            reducer=google.cloud.monitoring_v3.Aggregation.Reducer.REDUCE_MAX,
-            query_filter='metric.type = "kubernetes.io/container/cpu/core_usage_time"',
+        container_key = (
+            namespace,
+            container_name,
+            top_level_controller_name,
         )
 
-        async for metrics in results:
-            container = self.upsert_container(
-                metrics=metrics,
+        container = container_metrics.get(container_key)
+        if not container:
+            container_metrics[container_key] = container = ContainerMetrics(
+                namespace=namespace,
+                container_name=container_name,
+                top_level_controller_name=top_level_controller_name,
             )
 
-            container.max_cpu_usage = max(
-                metrics.points,
-                key=lambda point: point.value.double_value,
-            ).value.double_value
+        return container
 
-    async def query_avg_cpu_usage(
+    async def query_columns(
         self,
+        container_metrics,
+        columns,
+        update_derived_fields,
     ):
-        results = await self.query(
-            aligner=google.cloud.monitoring_v3.Aggregation.Aligner.ALIGN_RATE,
-            reducer=google.cloud.monitoring_v3.Aggregation.Reducer.REDUCE_MEAN,
-            query_filter='metric.type = "kubernetes.io/container/cpu/core_usage_time"',
-        )
+        columns_by_field = {
+            column.field: column for column in columns
+        }
+        label_indices = {}
+
+        async with contextlib.aclosing(
+            self.query_mql(
+                mql=self.build_mql(
+                    columns=columns,
+                ),
+            ),
+        ) as pages:
+            async for page in pages:
+                label_descriptors = page.time_series_descriptor.label_descriptors
+                if label_descriptors:
+                    label_indices = {
+                        label_descriptor.key.rsplit('.', 1)[-1]: index
+                        for index, label_descriptor in enumerate(label_descriptors)
+                    }
+
+                series = []
+                series_points = []
+
+                for time_series_data in page.time_series_data:
+                    points = time_series_data.point_data
+                    if not points:
+                        continue
+
+                    label_values = time_series_data.label_values
+                    container = self.upsert_container(
+                        container_metrics=container_metrics,
+                        namespace=sys.intern(label_values[label_indices['namespace_name']].string_value),
+                        container_name=sys.intern(label_values[label_indices['container_name']].string_value),
+                        top_level_controller_name=sys.intern(
+                            label_values[label_indices['top_level_controller_name']].string_value,
+                        ),
+                    )
+                    column = columns_by_field[label_values[label_indices[COLUMN_LABEL]].string_value]
+
+                    series.append((container, column))
+                    series_points.append(points)
+
+                if not series:
+                    continue
+
+                reductions = reduce_series_points(
+                    series_points=series_points,
+                )
+
+                for index, (container, column) in enumerate(series):
+                    setattr(
+                        container,
+                        column.field,
+                        column.value_type(reductions[column.reduce_points][index]),
+                    )
+
+                    update_derived_fields(container)
 
-        async for metrics in results:
-            container = self.upsert_container(
-                metrics=metrics,
-            )
+    async def query_memory_utilization(
+        self,
+    ) -> typing.List[ContainerMetrics]:
+        container_metrics = {}
 
-            container.avg_cpu_usage = metrics.points[0].value.double_value
+        await self.query_columns(
+            container_metrics=container_metrics,
+            columns=MEMORY_COLUMNS,
+            update_derived_fields=update_unutilized_memory,
+        )
+
+        return list(container_metrics.values())
 
-    async def query_cpu_request(
+    async def query_cpu_utilization(
         self,
-    ):
-        results = await self.query(
-            aligner=google.cloud.monitoring_v3.Aggregation.Aligner.ALIGN_MEAN,
-            reducer=google.cloud.monitoring_v3.Aggregation.Reducer.REDUCE_MAX,
-            query_filter='metric.type = "kubernetes.io/container/cpu/request_cores"',
+    ) -> typing.List[ContainerMetrics]:
+        container_metrics = {}
+
+        await self.query_columns(
+            container_metrics=container_metrics,
+            columns=CPU_COLUMNS,
+            update_derived_fields=update_unutilized_cpu,
         )
 
-        async for metrics in results:
-            container = self.upsert_container(
-                metrics=metrics,
-            )
+        return list(container_metrics.values())
+
+    async def query_all_utilization(
+        self,
+    ) -> typing.Tuple[typing.List[ContainerMetrics], typing.List[ContainerMetrics]]:
+        tasks = [
+            asyncio.ensure_future(self.query_memory_utilization()),
+            asyncio.ensure_future(self.query_cpu_utilization()),
+        ]
+
+        try:
+            memory_metrics, cpu_metrics = await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+            await asyncio.wait(tasks)
 
-            container.cpu_request = metrics.points[0].value.double_value
+        return memory_metrics, cpu_metrics
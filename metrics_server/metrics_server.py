@@ -1,10 +1,14 @@
+import asyncio
+import dataclasses
 import enum
+import os
+import re
+import time
 import typing
 
 import fastapi
+import fastapi.responses
 import pydantic
-import tabulate
-import termcolor
 
 from . import gcp_metrics_client
 
@@ -13,6 +17,7 @@ class Settings(
     pydantic.BaseSettings,
 ):
     project: str
+    cache_ttl_seconds: float = 180
 
 
 class OutputFormat(
@@ -30,8 +35,53 @@ class MetricType(
     cpu = 'cpu'
 
 
+@dataclasses.dataclass
+class CacheEntry:
+    timestamp: float
+    metrics: typing.Dict[MetricType, typing.List[gcp_metrics_client.ContainerMetrics]]
+    tables: typing.Dict[typing.Tuple[MetricType, OutputFormat], str] = dataclasses.field(
+        default_factory=dict,
+    )
+
+
+@dataclasses.dataclass
+class InFlightFetch:
+    done: asyncio.Event = dataclasses.field(
+        default_factory=asyncio.Event,
+    )
+    cache_entry: typing.Optional[CacheEntry] = None
+    exception: typing.Optional[Exception] = None
+
+
+MEBIBYTES_PER_BYTE = 1 / 1024 ** 2
+GIBIBYTES_PER_BYTE = 1 / 1024 ** 3
+
+ANSI_ESCAPE_PATTERN = re.compile(r'\x1b\[[0-9;]*m')
+
+if os.getenv('NO_COLOR'):
+    COLORS = {
+        'red': '',
+        'yellow': '',
+        'green': '',
+    }
+    RESET_COLOR = ''
+else:
+    COLORS = {
+        'red': '\x1b[31m',
+        'yellow': '\x1b[33m',
+        'green': '\x1b[32m',
+    }
+    RESET_COLOR = '\x1b[0m'
+
+
 settings = Settings()
-app = fastapi.FastAPI()
+app = fastapi.FastAPI(
+    default_response_class=fastapi.responses.ORJSONResponse,
+)
+
+cache: typing.Dict[tuple, CacheEntry] = {}
+cache_in_flight: typing.Dict[tuple, InFlightFetch] = {}
+cache_lock = asyncio.Lock()
 
 
 @app.get('/metrics/{metric_type}')
@@ -41,43 +91,138 @@ async def get_metrics(
     namespaces: typing.List[str] = fastapi.Query(None),
     output_format: OutputFormat = OutputFormat.table,
 ):
-    client = gcp_metrics_client.MetricsClient(
-        project=settings.project,
-        namespaces=namespaces,
+    try:
+        gcp_metrics_client.validate_namespaces(
+            namespaces=namespaces,
+        )
+    except ValueError as exception:
+        raise fastapi.HTTPException(
+            status_code=400,
+            detail=str(exception),
+        )
+
+    cache_entry = await get_cache_entry(
         duration_days=duration_days,
+        namespaces=namespaces,
     )
 
-    if metric_type == MetricType.memory:
-        metrics = await client.query_memory_utilization()
-    elif metric_type == MetricType.cpu:
-        metrics = await client.query_cpu_utilization()
-
     return format_metrics(
         metric_type=metric_type,
         output_format=output_format,
-        metrics=metrics,
+        cache_entry=cache_entry,
     )
 
 
+async def get_cache_entry(
+    duration_days: int,
+    namespaces: typing.Optional[typing.List[str]],
+) -> CacheEntry:
+    cache_key = (
+        duration_days,
+        tuple(sorted(namespaces or ())),
+    )
+
+    while True:
+        async with cache_lock:
+            cache_entry = cache.get(cache_key)
+            if cache_entry and time.monotonic() - cache_entry.timestamp < settings.cache_ttl_seconds:
+                return cache_entry
+
+            in_flight = cache_in_flight.get(cache_key)
+            if in_flight is None:
+                cache_in_flight[cache_key] = in_flight = InFlightFetch()
+
+                break
+
+        await in_flight.done.wait()
+
+        if in_flight.exception is not None:
+            raise in_flight.exception
+        if in_flight.cache_entry is not None:
+            return in_flight.cache_entry
+
+    try:
+        metrics = await query_metrics(
+            duration_days=duration_days,
+            namespaces=namespaces,
+        )
+
+        async with cache_lock:
+            now = time.monotonic()
+            for expired_key in [
+                key for key, entry in cache.items()
+                if now - entry.timestamp >= settings.cache_ttl_seconds
+            ]:
+                del cache[expired_key]
+
+            cache[cache_key] = in_flight.cache_entry = CacheEntry(
+                timestamp=now,
+                metrics=metrics,
+            )
+    except Exception as exception:
+        in_flight.exception = exception
+
+        raise
+    finally:
+        async with cache_lock:
+            del cache_in_flight[cache_key]
+
+        in_flight.done.set()
+
+    return in_flight.cache_entry
+
+
+async def query_metrics(
+    duration_days: int,
+    namespaces: typing.Optional[typing.List[str]],
+) -> typing.Dict[MetricType, typing.List[gcp_metrics_client.ContainerMetrics]]:
+    client = gcp_metrics_client.MetricsClient(
+        project=settings.project,
+        namespaces=namespaces,
+        duration_days=duration_days,
+    )
+
+    memory_metrics, cpu_metrics = await client.query_all_utilization()
+
+    return {
+        MetricType.memory: memory_metrics,
+        MetricType.cpu: cpu_metrics,
+    }
+
+
 def format_metrics(
     metric_type: MetricType,
     output_format: OutputFormat,
-    metrics: typing.List[gcp_metrics_client.ContainerMetrics],
+    cache_entry: CacheEntry,
 ):
     if output_format == OutputFormat.table:
-        if metric_type == MetricType.memory:
-            table = format_memory_metrics_as_table(
-                metrics=metrics,
-            )
-        elif metric_type == MetricType.cpu:
-            table = format_cpu_metrics_as_table(
-                metrics=metrics,
+        table = cache_entry.tables.get((metric_type, output_format))
+        if table is None:
+            cache_entry.tables[(metric_type, output_format)] = table = format_metrics_as_table(
+                metric_type=metric_type,
+                metrics=list(cache_entry.metrics[metric_type]),
             )
         return fastapi.Response(
             content=table + '\n',
         )
     elif output_format == OutputFormat.json:
-        return metrics
+        return fastapi.responses.ORJSONResponse(
+            content=cache_entry.metrics[metric_type],
+        )
+
+
+def format_metrics_as_table(
+    metric_type: MetricType,
+    metrics: typing.List[gcp_metrics_client.ContainerMetrics],
+):
+    if metric_type == MetricType.memory:
+        return format_memory_metrics_as_table(
+            metrics=metrics,
+        )
+    elif metric_type == MetricType.cpu:
+        return format_cpu_metrics_as_table(
+            metrics=metrics,
+        )
 
 
 def format_memory_metrics_as_table(
@@ -88,8 +233,17 @@ def format_memory_metrics_as_table(
         reverse=True,
     )
     table = []
+    total_avg_memory_request_utilization = 0.0
+    total_avg_memory_usage = 0.0
+    total_avg_memory_request = 0
+    total_unutilized_memory = 0
 
     for metric in metrics:
+        total_avg_memory_request_utilization += metric.avg_memory_request_utilization
+        total_avg_memory_usage += metric.avg_memory_usage
+        total_avg_memory_request += metric.memory_request
+        total_unutilized_memory += metric.unutilized_memory
+
         avg_memory_request_utilization = percentage_gradient(
             value=metric.avg_memory_request_utilization,
         )
@@ -102,46 +256,34 @@ def format_memory_metrics_as_table(
             [
                 metric.namespace,
                 f'{metric.top_level_controller_name}/{metric.container_name}',
-                f'{metric.memory_request / 1024 ** 2:.0f}M',
-                f'{metric.avg_memory_usage / 1024 ** 2:.0f}M',
-                f'{metric.max_memory_usage / 1024 ** 2:.0f}M',
+                f'{metric.memory_request * MEBIBYTES_PER_BYTE:.0f}M',
+                f'{metric.avg_memory_usage * MEBIBYTES_PER_BYTE:.0f}M',
+                f'{metric.max_memory_usage * MEBIBYTES_PER_BYTE:.0f}M',
                 avg_memory_request_utilization,
                 unutilized_memory,
             ],
         )
 
     total_avg_memory_request_utilization = percentage_gradient(
-        value=sum(
-            metric.avg_memory_request_utilization for metric in metrics
-        ) / len(metrics),
+        value=total_avg_memory_request_utilization / len(metrics),
     )
 
-    total_avg_memory_usage = sum(
-        metric.avg_memory_usage for metric in metrics
-    ) / len(metrics)
-
-    total_avg_memory_request = sum(
-        metric.memory_request for metric in metrics
-    )
-
-    total_unutilized_memory = sum(
-        metric.unutilized_memory for metric in metrics
-    )
+    total_avg_memory_usage /= len(metrics)
 
     table.append(
         [
             'Total',
             '',
-            f'{total_avg_memory_request / 1024 ** 3:.0f} GB',
-            f'{total_avg_memory_usage / 1024 ** 2:.0f}M',
+            f'{total_avg_memory_request * GIBIBYTES_PER_BYTE:.0f} GB',
+            f'{total_avg_memory_usage * MEBIBYTES_PER_BYTE:.0f}M',
             '',
             total_avg_memory_request_utilization,
-            f'{total_unutilized_memory / 1024 ** 3:.0f} GB',
+            f'{total_unutilized_memory * GIBIBYTES_PER_BYTE:.0f} GB',
         ],
     )
 
-    return tabulate.tabulate(
-        tabular_data=table,
+    return render_table(
+        rows=table,
         headers=[
             'Namespace',
             'Deployment/Container',
@@ -162,8 +304,17 @@ def format_cpu_metrics_as_table(
         reverse=True,
     )
     table = []
+    total_avg_cpu_request_utilization = 0.0
+    total_avg_cpu_usage = 0.0
+    total_avg_cpu_request = 0.0
+    total_unutilized_cpu = 0.0
 
     for metric in metrics:
+        total_avg_cpu_request_utilization += metric.avg_cpu_request_utilization
+        total_avg_cpu_usage += metric.avg_cpu_usage
+        total_avg_cpu_request += metric.cpu_request
+        total_unutilized_cpu += metric.unutilized_cpu
+
         avg_cpu_request_utilization = percentage_gradient(
             value=metric.avg_cpu_request_utilization,
         )
@@ -184,22 +335,10 @@ def format_cpu_metrics_as_table(
         )
 
     total_avg_cpu_request_utilization = percentage_gradient(
-        value=sum(
-            metric.avg_cpu_request_utilization for metric in metrics
-        ) / len(metrics),
-    )
-
-    total_avg_cpu_usage = sum(
-        metric.avg_cpu_usage for metric in metrics
-    ) / len(metrics)
-
-    total_avg_cpu_request = sum(
-        metric.cpu_request for metric in metrics
+        value=total_avg_cpu_request_utilization / len(metrics),
     )
 
-    total_unutilized_cpu = sum(
-        metric.unutilized_cpu for metric in metrics
-    )
+    total_avg_cpu_usage /= len(metrics)
 
     table.append(
         [
@@ -213,8 +352,8 @@ def format_cpu_metrics_as_table(
         ],
     )
 
-    return tabulate.tabulate(
-        tabular_data=table,
+    return render_table(
+        rows=table,
         headers=[
             'Namespace',
             'Deployment/Container',
@@ -226,38 +365,92 @@ def format_cpu_metrics_as_table(
     )
 
 
+def render_table(
+    rows: typing.List[list],
+    headers: typing.List[str],
+):
+    rows = [
+        [str(cell) for cell in row] for row in rows
+    ]
+    widths = [len(header) + 2 for header in headers]
+    numeric_columns = [True] * len(headers)
+
+    for row in rows:
+        for index, cell in enumerate(row):
+            visible_cell = ANSI_ESCAPE_PATTERN.sub('', cell)
+            if len(visible_cell) > widths[index]:
+                widths[index] = len(visible_cell)
+            if visible_cell and numeric_columns[index]:
+                numeric_columns[index] = is_number(
+                    text=visible_cell,
+                )
+
+    def render_row(
+        cells,
+    ):
+        rendered_cells = []
+
+        for cell, width, is_numeric in zip(cells, widths, numeric_columns):
+            padding = ' ' * (width - len(ANSI_ESCAPE_PATTERN.sub('', cell)))
+            if is_numeric:
+                rendered_cells.append(padding + cell)
+            else:
+                rendered_cells.append(cell + padding)
+
+        return '  '.join(rendered_cells).rstrip()
+
+    lines = [
+        render_row(
+            cells=headers,
+        ),
+        '  '.join('-' * width for width in widths),
+    ]
+    lines.extend(
+        render_row(
+            cells=row,
+        ) for row in rows
+    )
+
+    return '\n'.join(lines)
+
+
+def is_number(
+    text: str,
+):
+    try:
+        float(text)
+    except ValueError:
+        return False
+
+    return True
+
+
 def percentage_gradient(
     value,
 ):
     if value < 0.3:
-        color = 'red'
+        color = COLORS['red']
     elif value < 0.6:
-        color = 'yellow'
+        color = COLORS['yellow']
     else:
-        color = 'green'
+        color = COLORS['green']
 
-    return termcolor.colored(
-        text=f'{value:.0%}',
-        color=color,
-    )
+    return f'{color}{value:.0%}{RESET_COLOR}'
 
 
 def memory_bytes_gradient(
     value,
 ):
-    value_in_mb = int(value / 1024 ** 2)
+    value_in_mb = int(value * MEBIBYTES_PER_BYTE)
 
     if value_in_mb > 200:
-        color = 'red'
+        color = COLORS['red']
     elif value_in_mb > 100:
-        color = 'yellow'
+        color = COLORS['yellow']
     else:
-        color = 'green'
+        color = COLORS['green']
 
-    return termcolor.colored(
-        text=f'{value_in_mb}M',
-        color=color,
-    )
+    return f'{color}{value_in_mb}M{RESET_COLOR}'
 
 
 def cpu_gradient(
@@ -266,13 +459,10 @@ def cpu_gradient(
     value_in_milicores = int(value * 1000)
 
     if value_in_milicores > 1000:
-        color = 'red'
+        color = COLORS['red']
     elif value_in_milicores > 100:
-        color = 'yellow'
+        color = COLORS['yellow']
     else:
-        color = 'green'
+        color = COLORS['green']
 
-    return termcolor.colored(
-        text=value_in_milicores,
-        color=color,
-    )
+    return f'{color}{value_in_milicores}{RESET_COLOR}'
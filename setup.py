@@ -4,11 +4,12 @@ import setuptools
 setuptools.setup(
     name='metrics_server',
     packages=setuptools.find_packages(),
+    python_requires='>=3.10',
     install_requires=[
         'fastapi',
         'google-cloud-monitoring',
-        'tabulate',
-        'termcolor',
+        'numpy',
+        'orjson',
         'uvicorn',
     ],
 )